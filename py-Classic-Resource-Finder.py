@@ -18,16 +18,92 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import gc
 import getopt
+import gzip
+import heapq
+import json
 import os
+import sqlite3
 import sys
-from datetime import datetime
-from multiprocessing import Process
-
-import boto3
-import boto3.session
-import botocore.exceptions
-from botocore.config import Config
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Value
+
+
+# boto3 and botocore are imported by importboto() when they are first needed, so that --help and argument errors
+# return straight away
+
+boto3 = None
+botocore = None
+Config = None
+
+# Regions which support EC2-Classic, and the regions of those where Data Pipeline is available
+
+classicregions = ('us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1', 'ap-southeast-1', 'ap-southeast-2',
+                  'ap-northeast-1', 'sa-east-1',)
+datapipelineregions = ('us-east-1', 'eu-west-1', 'ap-northeast-1', 'us-west-2', 'ap-southeast-2')
+
+# Output formats, the run level file suffix for each and the columns written for every record
+
+outputformats = ('csv', 'jsonl', 'parquet')
+runfilesuffixes = {'jsonl': 'Classic_Resources.jsonl.gz', 'parquet': 'Classic_Resources.parquet'}
+recordcolumns = ('account', 'region', 'service', 'resourceid', 'status')
+
+# Page size used by default for each paged operation, the smallest and largest page sizes it accepts, and the names
+# of the token it returns and accepts for the next page
+
+pagedoperations = {
+    'describe_instances': (200, 5, 1000, 'NextToken', 'NextToken'),
+    'describe_security_groups': (200, 5, 1000, 'NextToken', 'NextToken'),
+    'describe_auto_scaling_groups': (100, 1, 100, 'NextToken', 'NextToken'),
+    'describe_load_balancers': (200, 1, 400, 'NextMarker', 'Marker'),
+    'describe_db_instances': (100, 20, 100, 'Marker', 'Marker'),
+    'describe_cache_clusters': (100, 20, 100, 'Marker', 'Marker'),
+    'describe_clusters': (100, 20, 100, 'Marker', 'Marker'),
+    'describe_environments': (100, 1, 1000, 'NextToken', 'NextToken'),
+}
+
+# Page sizes chosen with --page-size and the memory cap of each worker in bytes, set by each unit of work from the
+# options it is given
+
+scanlimits = {'pagesizes': {}, 'memorycap': 0}
+
+# Schema for the optional SQLite results database. Every account scan is stored with its scan time, along with the
+# region and service checks it ran, and the views only consider the latest check of each region and service of an
+# account, so a scan of only some services or regions does not hide the results of an earlier full scan. The scan
+# time of the latest check is kept in latest_checks as each account is written, so the views look it up by key
+# rather than searching every check ever run
+
+databaseschema = (
+    'CREATE TABLE IF NOT EXISTS resources (scantime TEXT NOT NULL, account TEXT NOT NULL, region TEXT NOT NULL, '
+    'service TEXT NOT NULL, resourceid TEXT NOT NULL, status TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS checks (scantime TEXT NOT NULL, account TEXT NOT NULL, region TEXT NOT NULL, '
+    'service TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS latest_checks (account TEXT NOT NULL, region TEXT NOT NULL, service TEXT NOT NULL, '
+    'scantime TEXT NOT NULL, PRIMARY KEY (account, region, service)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS resources_account ON resources (account, scantime)',
+    'CREATE INDEX IF NOT EXISTS resources_check ON resources (account, region, service, scantime)',
+    'CREATE INDEX IF NOT EXISTS resources_region ON resources (region, service)',
+    'CREATE INDEX IF NOT EXISTS resources_service ON resources (service, status)',
+    'CREATE INDEX IF NOT EXISTS checks_check ON checks (account, region, service, scantime)',
+    'DROP VIEW IF EXISTS latest_resources',
+    'CREATE VIEW latest_resources AS SELECT resources.* FROM latest_checks JOIN resources USING (account, region, '
+    'service, scantime)',
+    "CREATE VIEW IF NOT EXISTS account_summary AS SELECT account, MAX(scantime) AS scantime, "
+    "SUM(status = 'Classic') AS classic_resources, SUM(service = 'platform' AND status = 'Enabled') AS "
+    "enabled_regions, SUM(status = 'UNKNOWN') AS unknown_checks FROM latest_resources GROUP BY account",
+    "CREATE VIEW IF NOT EXISTS account_service_summary AS SELECT account, service, COUNT(*) AS classic_resources, "
+    "COUNT(DISTINCT region) AS regions FROM latest_resources WHERE status = 'Classic' GROUP BY account, service",
+    "CREATE VIEW IF NOT EXISTS region_service_summary AS SELECT region, service, COUNT(*) AS classic_resources, "
+    "COUNT(DISTINCT account) AS accounts FROM latest_resources WHERE status = 'Classic' GROUP BY region, service",
+)
 
 
 # Parses the input arguments
@@ -35,19 +111,51 @@ from botocore.config import Config
 
 def argparser(argv):
     try:
-        opts, args = getopt.getopt(argv, "hop:r:e:", ["help", "organization", "profile=", "rolename=", "externalid="])
+        opts, args = getopt.getopt(argv, "hop:r:e:f:tw:gs:", ["help", "organization", "profile=", "rolename=",
+                                                          "externalid=", "format=", "sqlite=", "triage", "workers=",
+                                                          "history=", "graph", "services=", "regions=", "serve=",
+                                                          "interval=", "rotation=", "compare=", "page-size=",
+                                                          "memory-cap="])
     except getopt.GetoptError:
-        print('This only accepts -h --help, -o --organization, -p --profile <comma delimited list of profile names>')
+        print('This only accepts -h --help, -o --organization, -p --profile <comma delimited list of profile names>, '
+              '-f --format <csv, jsonl or parquet>, --sqlite <database file>, -t --triage, -w --workers <number of '
+              'worker processes>, --history <history file>, -g --graph, -s --services <comma delimited list of '
+              'services>, --regions <comma delimited list of regions>, --serve <port>, --interval <seconds>, '
+              '--rotation <number of accounts>, --compare <previous results file>,<new results file>, --page-size '
+              '<comma delimited list of operation=page size>, --memory-cap <MB per worker>')
         sys.exit(2)
     orgarg = False
     profilearg = False
+    formatarg = False
     orgdict = {}
+    options = {'format': 'csv', 'workers': 8, 'history': 'classic-resource-finder-history.json',
+               'services': tuple(servicechecks), 'regions': classicregions, 'interval': 3600, 'rotation': 0,
+               'pagesizes': {}, 'memorycap': 0}
     for opt, arg in opts:
-        if opt == '-h':
+        if opt in ('-h', '--help'):
             print('You can use the following arguments, -o to run against all accounts in an organization, or -p '
                   '<comma delimited list of profile names> to run using locally configured profiles configured using '
                   'the AWS CLI. If you run this without any arguments it will run against the default credentials '
-                  'configured using the AWS CLI or the instance role if running on EC2.')
+                  'configured using the AWS CLI or the instance role if running on EC2. Use -f <csv, jsonl or parquet> '
+                  'to choose the output format. csv writes a set of CSVs per service for each account, jsonl and '
+                  'parquet write a single compressed record file for the whole run. Use --sqlite <database file> to '
+                  'also write the results to an indexed SQLite database. Use -t to only find which accounts have any '
+                  'Classic resources, writing a single yes, no or unknown row per account, so it cannot be used with '
+                  '-f, --sqlite or -g. Use -w <number> to set the number of worker processes, 8 by default, and '
+                  '--history <file> to choose where the duration of each check is kept between runs, used to start '
+                  'the longest checks first. Use -g to also write the '
+                  'attributes, tags and dependencies of the Classic resources found for each account. Use -s '
+                  '<comma delimited list of services> and --regions <comma delimited list of regions> to only check '
+                  'some services or regions. The services are ' + ', '.join(servicechecks) + ' and the regions are ' +
+                  ', '.join(classicregions) + '. Use --serve <port> to keep running and serve the latest results as '
+                  'JSON on the local host, rescanning --rotation <number> accounts, all by default, every --interval '
+                  '<seconds>, 3600 by default. Results are kept in memory, so -f cannot be used with --serve. Use '
+                  '--compare <previous results file>,<new results file> to summarise the jsonl or parquet output of '
+                  'a run and write the resources added and removed since an earlier run, without checking any '
+                  'accounts. Use '
+                  '--page-size <comma delimited list of operation=page size> to change the page size of the paged '
+                  'operations, which are ' + ', '.join(pagedoperations) + ', and --memory-cap <MB> to fetch smaller '
+                  'pages while a worker process is using more memory than that.')
             sys.exit()
         elif opt in ("-o", "--organization"):
             orgarg = True
@@ -58,12 +166,129 @@ def argparser(argv):
             orgdict['rolename'] = arg
         elif opt in ("-e", "--externalid"):
             orgdict['externalid'] = arg
+        elif opt in ("-f", "--format"):
+            if arg not in outputformats:
+                print('The output format must be one of ' + ', '.join(outputformats))
+                sys.exit(2)
+            options['format'] = arg
+            formatarg = True
+        elif opt == "--sqlite":
+            options['sqlite'] = arg
+        elif opt in ("-t", "--triage"):
+            options['triage'] = True
+        elif opt in ("-w", "--workers"):
+            if not arg.isdigit() or int(arg) < 1:
+                print('The number of workers must be a whole number of 1 or more')
+                sys.exit(2)
+            options['workers'] = int(arg)
+        elif opt == "--history":
+            options['history'] = arg
+        elif opt in ("-g", "--graph"):
+            options['graph'] = True
+        elif opt in ("-s", "--services"):
+            selectedservices = arg.split(',')
+            for servicename in selectedservices:
+                if servicename not in servicechecks:
+                    print(servicename + ' is not a service that can be checked. The services are ' +
+                          ', '.join(servicechecks))
+                    sys.exit(2)
+            options['services'] = tuple(servicename for servicename in servicechecks
+                                        if servicename in selectedservices)
+        elif opt == "--regions":
+            selectedregions = arg.split(',')
+            for regionname in selectedregions:
+                if regionname not in classicregions:
+                    print(regionname + ' is not a region that supports EC2-Classic. The regions are ' +
+                          ', '.join(classicregions))
+                    sys.exit(2)
+            options['regions'] = tuple(regionname for regionname in classicregions
+                                       if regionname in selectedregions)
+        elif opt in ("--serve", "--interval", "--rotation"):
+            if not arg.isdigit():
+                print(opt + ' must be a whole number')
+                sys.exit(2)
+            options[opt[2:]] = int(arg)
+        elif opt == "--compare":
+            comparefiles = arg.split(',')
+            if len(comparefiles) != 2:
+                print('--compare takes the previous and new results files separated by a comma')
+                sys.exit(2)
+            for comparefile in comparefiles:
+                if not os.path.exists(comparefile):
+                    print(comparefile + ' does not exist')
+                    sys.exit(2)
+            options['compare'] = tuple(comparefiles)
+        elif opt == "--page-size":
+            for pagesizearg in arg.split(','):
+                operationname, separator, pagesize = pagesizearg.partition('=')
+                if operationname not in pagedoperations:
+                    print(operationname + ' is not a paged operation. The paged operations are ' +
+                          ', '.join(pagedoperations))
+                    sys.exit(2)
+                minimumpagesize, maximumpagesize = pagedoperations[operationname][1:3]
+                if not pagesize.isdigit() or not minimumpagesize <= int(pagesize) <= maximumpagesize:
+                    print('The page size for ' + operationname + ' must be a whole number from ' +
+                          str(minimumpagesize) + ' to ' + str(maximumpagesize))
+                    sys.exit(2)
+                options['pagesizes'][operationname] = int(pagesize)
+        elif opt == "--memory-cap":
+            if not arg.isdigit() or int(arg) < 1:
+                print('The memory cap must be a whole number of MB of 1 or more')
+                sys.exit(2)
+            options['memorycap'] = int(arg) * 1048576
+    if 'triage' in options and (formatarg or 'sqlite' in options or 'graph' in options):
+        print('-t --triage only writes the triage results and cannot be used with -f --format, --sqlite or -g --graph')
+        sys.exit(2)
+    if 'triage' in options and not any(servicename in triageorder and servicename != 'platform'
+                                       for regionname, servicename in buildscanplan(options)['units']):
+        print('Triage needs at least one of the services ' + ', '.join(triageorder[1:]) + ' to be checked in the '
+              'selected regions. Security Groups are not checked in triage mode.')
+        sys.exit(2)
+    if 'serve' in options:
+        if 'triage' in options:
+            print('--serve cannot be used with -t --triage')
+            sys.exit(2)
+        if formatarg:
+            print('--serve keeps the results in memory and cannot be used with -f --format')
+            sys.exit(2)
+    if options['format'] == 'parquet' or any(comparefile.endswith('.parquet')
+                                              for comparefile in options.get('compare', ())):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print('Parquet files require pyarrow. Install it using pip install pyarrow, or use -f jsonl.')
+            sys.exit(2)
     if orgarg:
-        return orgdict
+        return orgdict, options
     elif profilearg:
-        return profiledict
+        return profiledict, options
     else:
-        return str('default')
+        return str('default'), options
+
+
+# Imports boto3 and botocore into the module globals
+
+
+def importboto():
+    global boto3, botocore, Config
+    if boto3 is None:
+        import boto3
+        import boto3.session
+        import botocore.exceptions
+        from botocore.config import Config
+
+
+# Builds the list of region and service checks to run for each account from the selected services and regions
+
+
+def buildscanplan(options):
+    units = list()
+    for regionname in options['regions']:
+        for servicename in options['services']:
+            if servicename == 'datapipeline' and regionname not in datapipelineregions:
+                continue
+            units.append((regionname, servicename))
+    return {'regions': options['regions'], 'services': options['services'], 'units': tuple(units)}
 
 
 # Delete File function
@@ -81,6 +306,8 @@ def deletefile(filename):
 
 
 def fileconcatenator(executionprefixobj, regionnameobj, filename, outputobj):
+    if not os.path.exists(executionprefixobj + regionnameobj + filename):
+        return
     readfile = open(executionprefixobj + regionnameobj + filename, 'r')
     outputobj.write(readfile.read())
     readfile.close()
@@ -101,10 +328,262 @@ def filewriter(prefixobj, efileobj, inputlist, currentregionnameobj, suffixobj):
         writefile.close()
 
 
+# Converts the output of a check into typed records. Checks which failed are recorded with a status of UNKNOWN, and
+# checks which found nothing with a status of Not found, so every check run has at least one record
+
+
+def buildrecords(accountobj, currentregionnameobj, servicename, inputresult):
+    if isinstance(inputresult, str):
+        # The platform status check returns a single status rather than a list of resources
+        return [dict(zip(recordcolumns, (accountobj, currentregionnameobj, servicename, '', inputresult)))]
+    if tuple(inputresult) == ('UNKNOWN',):
+        return [dict(zip(recordcolumns, (accountobj, currentregionnameobj, servicename, '', 'UNKNOWN')))]
+    if not inputresult:
+        return [dict(zip(recordcolumns, (accountobj, currentregionnameobj, servicename, '', 'Not found')))]
+    return [dict(zip(recordcolumns, (accountobj, currentregionnameobj, servicename, resourceid, 'Classic')))
+            for resourceid in inputresult]
+
+
+# Writes the records for a region to a compressed JSONL part file for later aggregation into the run output
+
+
+def recordpartwriter(partfilename, efileobj, recordlist, currentregionnameobj):
+    try:
+        with gzip.open(partfilename, 'at', encoding='utf-8') as writefile:
+            writefile.writelines(json.dumps(record, separators=(',', ':')) + '\n' for record in recordlist)
+    except Exception as e:
+        efileobj.write('Records for ' + currentregionnameobj + ' failed to write. Error: ' + str(e))
+
+
+# Creates the results database if it does not exist. WAL mode lets the region workers write while others read
+
+
+def initdatabase(databasefile):
+    connection = sqlite3.connect(databasefile)
+    try:
+        connection.execute('PRAGMA journal_mode=WAL')
+        tablenames = set(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        for statement in databaseschema:
+            connection.execute(statement)
+        if 'checks' not in tablenames:
+            # Databases written before checks were stored are taken to have checked each region and service they
+            # have records for
+            connection.execute('INSERT INTO checks SELECT DISTINCT scantime, account, region, service FROM resources')
+        if 'latest_checks' not in tablenames:
+            connection.execute('INSERT INTO latest_checks SELECT account, region, service, MAX(scantime) FROM checks '
+                               'GROUP BY account, region, service')
+        connection.commit()
+    finally:
+        connection.close()
+
+
+# Writes the region and service checks run for an account and the records they found to the results database in a
+# single transaction, moving the latest check of each region and service on to this scan. Checks which found nothing
+# are only kept in the checks table
+
+
+def databasewriter(databasefile, efileobj, scantime, accountid, checklist, recordlist):
+    try:
+        connection = sqlite3.connect(databasefile, timeout=60)
+        try:
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                connection.executemany('INSERT INTO checks VALUES (?, ?, ?, ?)',
+                                       ((scantime, accountid, regionname, servicename)
+                                        for regionname, servicename in checklist))
+                connection.executemany('INSERT INTO latest_checks VALUES (?, ?, ?, ?) ON CONFLICT (account, region, '
+                                       'service) DO UPDATE SET scantime = excluded.scantime WHERE excluded.scantime > '
+                                       'latest_checks.scantime',
+                                       ((accountid, regionname, servicename, scantime)
+                                        for regionname, servicename in checklist))
+                connection.executemany('INSERT INTO resources VALUES (?, ?, ?, ?, ?, ?)',
+                                       ((scantime,) + tuple(record[column] for column in recordcolumns)
+                                        for record in recordlist if record['status'] != 'Not found'))
+        finally:
+            connection.close()
+    except Exception as e:
+        efileobj.write('Database records for ' + accountid + ' failed to write. Error: ' + str(e))
+
+
+# Buffers records for the whole run and writes them in batches to a single compressed JSONL or Parquet file
+
+
+class RecordWriter:
+    def __init__(self, outputformat, filename, batchsize=10000):
+        self.outputformat = outputformat
+        self.filename = filename
+        self.batchsize = batchsize
+        self.buffer = list()
+        self.parquetwriter = None
+        if outputformat == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema([(column, pyarrow.string()) for column in recordcolumns])
+            self.parquetwriter = pyarrow.parquet.ParquetWriter(filename, self.schema)
+            self.outputfile = None
+        else:
+            self.outputfile = open(filename, 'ab')
+
+    def write(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batchsize:
+            self.flush()
+
+    def appendpart(self, partfilename):
+        if not os.path.exists(partfilename):
+            return
+        if self.outputformat == 'jsonl':
+            # gzip members can be concatenated, so part files are copied without decompressing them
+            self.flush()
+            with open(partfilename, 'rb') as readfile:
+                while True:
+                    chunk = readfile.read(1048576)
+                    if not chunk:
+                        break
+                    self.outputfile.write(chunk)
+        else:
+            with gzip.open(partfilename, 'rt', encoding='utf-8') as readfile:
+                for line in readfile:
+                    self.write(json.loads(line))
+        deletefile(partfilename)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.parquetwriter is not None:
+            self.parquetwriter.write_table(self.pyarrow.Table.from_pylist(self.buffer, schema=self.schema))
+        else:
+            with gzip.open(self.outputfile, 'wt', encoding='utf-8') as writefile:
+                writefile.writelines(json.dumps(record, separators=(',', ':')) + '\n' for record in self.buffer)
+        self.buffer = list()
+
+    def close(self):
+        self.flush()
+        if self.parquetwriter is not None:
+            self.parquetwriter.close()
+        else:
+            self.outputfile.close()
+
+
+# Copies the listed attributes of a resource which are present in the API response
+
+
+def pickattributes(resourcedata, attributenames):
+    return {attributename: resourcedata[attributename] for attributename in attributenames
+            if attributename in resourcedata}
+
+
+# Returns the resident memory of this process in bytes, or 0 where /proc is not available
+
+
+def workermemory():
+    try:
+        with open('/proc/self/statm', 'r') as statmfile:
+            return int(statmfile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+# Resident memory of a new worker process once boto3 and a client are loaded, before it has fetched anything
+
+
+def baselinememory():
+    getclient({}, classicregions[0], 'ec2')
+    return workermemory()
+
+
+# Checks whether this worker is over its memory cap, after collecting garbage
+
+
+def overmemorycap():
+    if not scanlimits['memorycap'] or workermemory() < scanlimits['memorycap']:
+        return False
+    gc.collect()
+    return workermemory() >= scanlimits['memorycap']
+
+
+# Lists the items of a page, following nested lists such as the instances of each reservation
+
+
+def pageitems(page, resultpath):
+    items = page.get(resultpath[0], ())
+    for resultkey in resultpath[1:]:
+        items = [subitem for item in items for subitem in item.get(resultkey, ())]
+    return items
+
+
+# Pages through an operation one page at a time and yields each item with only the fields a check needs. Each page
+# is dropped once its items are projected, before the next page is requested, and while the worker is over its
+# memory cap the following pages are fetched at half the size, down to the smallest the operation accepts. The page
+# size goes back to the one chosen once the worker is under its cap
+
+
+def fetchitems(client, operationname, resultpath, fields, **operationparameters):
+    defaultpagesize, minimumpagesize, maximumpagesize, outputtoken, inputtoken = pagedoperations[operationname]
+    chosenpagesize = scanlimits['pagesizes'].get(operationname, defaultpagesize)
+    pagesize = chosenpagesize
+    paginator = client.get_paginator(operationname)
+    while True:
+        page = next(iter(paginator.paginate(PaginationConfig={'PageSize': pagesize}, **operationparameters)))
+        items = [pickattributes(item, fields) for item in pageitems(page, resultpath)]
+        nexttoken = page.get(outputtoken)
+        page = None
+        for item in items:
+            yield item
+        items = None
+        if not nexttoken:
+            return
+        operationparameters[inputtoken] = nexttoken
+        if overmemorycap():
+            pagesize = max(minimumpagesize, pagesize // 2)
+        else:
+            pagesize = chosenpagesize
+
+
+# Attributes, tags and dependencies of the Classic resources found, captured from the responses the checks already
+# receive. Each check fills an index which is saved to a part file, and the part files for an account are merged to
+# cross-reference the dependencies between resources found by different checks
+
+
+class ResourceIndex:
+    def __init__(self):
+        self.resources = dict()
+        self.edges = list()
+
+    def addresource(self, region, servicename, resourceid, attributes, tags=None):
+        if tags:
+            attributes['Tags'] = {tag['Key']: tag.get('Value', '') for tag in tags}
+        self.resources[(region, servicename, resourceid)] = attributes
+
+    def addedge(self, region, sourceservice, sourceid, relation, targetservice, targetid):
+        self.edges.append((region, sourceservice, sourceid, relation, targetservice, targetid))
+
+    def save(self, filename):
+        with open(filename, 'w') as writefile:
+            json.dump({'resources': [list(resourcekey) + [attributes]
+                                     for resourcekey, attributes in self.resources.items()],
+                       'edges': self.edges}, writefile, default=str)
+
+    def load(self, filename):
+        with open(filename, 'r') as readfile:
+            indexdata = json.load(readfile)
+        for region, servicename, resourceid, attributes in indexdata['resources']:
+            self.resources[(region, servicename, resourceid)] = attributes
+        self.edges.extend(tuple(edge) for edge in indexdata['edges'])
+
+    def dependents(self):
+        resourcedependents = dict()
+        for region, sourceservice, sourceid, relation, targetservice, targetid in self.edges:
+            resourcedependents.setdefault((region, targetservice, targetid), list()).append(
+                sourceservice + ' ' + sourceid + ' ' + relation)
+        return resourcedependents
+
+
 # Gets the Classic Platform Status for the region
 
 
-def classicplatformstatus(ec2client, errorfileobj, currentregion):
+def classicplatformstatus(ec2client, errorfileobj, currentregion, index=None):
     try:
         accountattributes = ec2client.describe_account_attributes(
             AttributeNames=[
@@ -133,7 +612,7 @@ def classicplatformstatus(ec2client, errorfileobj, currentregion):
 # Gets all Classic EIPs
 
 
-def classiceips(ec2client, errorfileobj, currentregion):
+def classiceips(ec2client, errorfileobj, currentregion, index=None):
     try:
         eips = ec2client.describe_addresses(
             Filters=[
@@ -148,6 +627,12 @@ def classiceips(ec2client, errorfileobj, currentregion):
         eiplist = list()
         for address in eips['Addresses']:
             eiplist.append(address['PublicIp'])
+            if index is not None:
+                index.addresource(currentregion, 'eip', address['PublicIp'],
+                                  pickattributes(address, ('InstanceId', 'PrivateIpAddress')), address.get('Tags'))
+                if address.get('InstanceId'):
+                    index.addedge(currentregion, 'eip', address['PublicIp'], 'associated with', 'ec2',
+                                  address['InstanceId'])
         return eiplist
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_addresses in ' + currentregion + ' returned: ' + str(error))
@@ -163,18 +648,30 @@ def classiceips(ec2client, errorfileobj, currentregion):
 # Get all Classic EC2 Instances
 
 
-def classicec2instances(ec2client, errorfileobj, currentregion):
+def classicec2instances(ec2client, errorfileobj, currentregion, index=None):
     try:
-        paginator = ec2client.get_paginator('describe_instances')
         operation_parameters = {'Filters': [
             {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']}]}
-        page_iterator = paginator.paginate(**operation_parameters)
+        fields = ('InstanceId', 'VpcId')
+        if index is not None:
+            fields += ('InstanceType', 'ImageId', 'KeyName', 'LaunchTime', 'PrivateIpAddress', 'PublicIpAddress',
+                       'State', 'Placement', 'Tags', 'SecurityGroups')
         classicinstances = list()
-        for page in page_iterator:
-            for reservation in page['Reservations']:
-                for instance in reservation['Instances']:
-                    if 'VpcId' not in instance.keys():
-                        classicinstances.append(instance['InstanceId'])
+        for instance in fetchitems(ec2client, 'describe_instances', ('Reservations', 'Instances'), fields,
+                                   **operation_parameters):
+            if 'VpcId' not in instance.keys():
+                classicinstances.append(instance['InstanceId'])
+                if index is not None:
+                    attributes = pickattributes(instance, ('InstanceType', 'ImageId', 'KeyName', 'LaunchTime',
+                                                           'PrivateIpAddress', 'PublicIpAddress'))
+                    if 'State' in instance:
+                        attributes['State'] = instance['State']['Name']
+                    if 'Placement' in instance:
+                        attributes['AvailabilityZone'] = instance['Placement'].get('AvailabilityZone')
+                    index.addresource(currentregion, 'ec2', instance['InstanceId'], attributes, instance.get('Tags'))
+                    for group in instance.get('SecurityGroups', ()):
+                        index.addedge(currentregion, 'ec2', instance['InstanceId'], 'uses', 'securitygroup',
+                                      group['GroupId'])
         return classicinstances
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_instances in ' + currentregion + ' returned: ' + str(error))
@@ -190,15 +687,23 @@ def classicec2instances(ec2client, errorfileobj, currentregion):
 # Get all Classic Security Groups
 
 
-def classicsecuritygroups(ec2client, errorfileobj, currentregion):
+def classicsecuritygroups(ec2client, errorfileobj, currentregion, index=None):
     try:
-        paginator = ec2client.get_paginator('describe_security_groups')
-        page_iterator = paginator.paginate()
+        fields = ('GroupId', 'VpcId')
+        if index is not None:
+            fields += ('GroupName', 'Description', 'Tags', 'IpPermissions')
         classicsgs = list()
-        for page in page_iterator:
-            for sgdata in page['SecurityGroups']:
-                if 'VpcId' not in sgdata.keys():
-                    classicsgs.append(sgdata['GroupId'])
+        for sgdata in fetchitems(ec2client, 'describe_security_groups', ('SecurityGroups',), fields):
+            if 'VpcId' not in sgdata.keys():
+                classicsgs.append(sgdata['GroupId'])
+                if index is not None:
+                    index.addresource(currentregion, 'securitygroup', sgdata['GroupId'],
+                                      pickattributes(sgdata, ('GroupName', 'Description')), sgdata.get('Tags'))
+                    for permission in sgdata.get('IpPermissions', ()):
+                        for grouppair in permission.get('UserIdGroupPairs', ()):
+                            if 'GroupId' in grouppair and grouppair['GroupId'] != sgdata['GroupId']:
+                                index.addedge(currentregion, 'securitygroup', sgdata['GroupId'], 'allows',
+                                              'securitygroup', grouppair['GroupId'])
         return classicsgs
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_security_groups in ' + currentregion + ' returned: ' + str(error))
@@ -214,7 +719,7 @@ def classicsecuritygroups(ec2client, errorfileobj, currentregion):
 # Get all VPCs with ClassicLink Enabled
 
 
-def classiclinks(ec2client, errorfileobj, currentregion):
+def classiclinks(ec2client, errorfileobj, currentregion, index=None):
     try:
         classiclinkvpcs = ec2client.describe_vpc_classic_link(
             Filters=[
@@ -229,6 +734,8 @@ def classiclinks(ec2client, errorfileobj, currentregion):
         classiclinkvpcslist = list()
         for vpccl in classiclinkvpcs['Vpcs']:
             classiclinkvpcslist.append(vpccl['VpcId'])
+            if index is not None:
+                index.addresource(currentregion, 'classiclink', vpccl['VpcId'], dict(), vpccl.get('Tags'))
         return classiclinkvpcslist
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_vpc_classic_link in ' + currentregion + ' returned: ' + str(error))
@@ -244,15 +751,33 @@ def classiclinks(ec2client, errorfileobj, currentregion):
 # Get all ASGs without a VPC configured
 
 
-def classicasgs(asgclient, errorfileobj, currentregion):
+def classicasgs(asgclient, errorfileobj, currentregion, index=None):
     try:
-        paginator = asgclient.get_paginator('describe_auto_scaling_groups')
-        page_iterator = paginator.paginate()
+        fields = ('AutoScalingGroupARN', 'VPCZoneIdentifier')
+        if index is not None:
+            fields += ('AutoScalingGroupName', 'LaunchConfigurationName', 'MinSize', 'MaxSize', 'DesiredCapacity',
+                       'Tags', 'LaunchTemplate', 'LoadBalancerNames', 'Instances')
         classicasglist = list()
-        for page in page_iterator:
-            for asgdata in page['AutoScalingGroups']:
-                if asgdata['VPCZoneIdentifier'] == '':
-                    classicasglist.append(asgdata['AutoScalingGroupARN'])
+        for asgdata in fetchitems(asgclient, 'describe_auto_scaling_groups', ('AutoScalingGroups',), fields):
+            if asgdata['VPCZoneIdentifier'] == '':
+                classicasglist.append(asgdata['AutoScalingGroupARN'])
+                if index is not None:
+                    asgarn = asgdata['AutoScalingGroupARN']
+                    index.addresource(currentregion, 'autoscaling', asgarn,
+                                      pickattributes(asgdata, ('AutoScalingGroupName', 'LaunchConfigurationName',
+                                                               'MinSize', 'MaxSize', 'DesiredCapacity')),
+                                      asgdata.get('Tags'))
+                    if asgdata.get('LaunchConfigurationName'):
+                        index.addedge(currentregion, 'autoscaling', asgarn, 'launches from', 'launchconfiguration',
+                                      asgdata['LaunchConfigurationName'])
+                    if asgdata.get('LaunchTemplate'):
+                        index.addedge(currentregion, 'autoscaling', asgarn, 'launches from', 'launchtemplate',
+                                      asgdata['LaunchTemplate'].get('LaunchTemplateId', ''))
+                    for loadbalancername in asgdata.get('LoadBalancerNames', ()):
+                        index.addedge(currentregion, 'autoscaling', asgarn, 'registers with', 'clb', loadbalancername)
+                    for asginstance in asgdata.get('Instances', ()):
+                        index.addedge(currentregion, 'autoscaling', asgarn, 'manages', 'ec2',
+                                      asginstance['InstanceId'])
         return classicasglist
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_auto_scaling_groups in ' + currentregion + ' returned: ' + str(error))
@@ -268,15 +793,21 @@ def classicasgs(asgclient, errorfileobj, currentregion):
 # Get all CLBs running in EC2-Classic
 
 
-def classicclbs(elbclient, errorfileobj, currentregion):
+def classicclbs(elbclient, errorfileobj, currentregion, index=None):
     try:
-        paginator = elbclient.get_paginator('describe_load_balancers')
-        page_iterator = paginator.paginate()
+        fields = ('LoadBalancerName', 'VPCId')
+        if index is not None:
+            fields += ('DNSName', 'Scheme', 'CreatedTime', 'Instances')
         classicclblist = list()
-        for page in page_iterator:
-            for clbdata in page['LoadBalancerDescriptions']:
-                if 'VPCId' not in clbdata.keys():
-                    classicclblist.append(clbdata['LoadBalancerName'])
+        for clbdata in fetchitems(elbclient, 'describe_load_balancers', ('LoadBalancerDescriptions',), fields):
+            if 'VPCId' not in clbdata.keys():
+                classicclblist.append(clbdata['LoadBalancerName'])
+                if index is not None:
+                    index.addresource(currentregion, 'clb', clbdata['LoadBalancerName'],
+                                      pickattributes(clbdata, ('DNSName', 'Scheme', 'CreatedTime')))
+                    for clbinstance in clbdata.get('Instances', ()):
+                        index.addedge(currentregion, 'clb', clbdata['LoadBalancerName'], 'routes to', 'ec2',
+                                      clbinstance['InstanceId'])
         return classicclblist
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_load_balancers in ' + currentregion + ' returned: ' + str(error))
@@ -292,15 +823,24 @@ def classicclbs(elbclient, errorfileobj, currentregion):
 # Get all Classic RDS instances
 
 
-def classicrds(rdsclient, errorfileobj, currentregion):
+def classicrds(rdsclient, errorfileobj, currentregion, index=None):
     try:
-        paginator = rdsclient.get_paginator('describe_db_instances')
-        page_iterator = paginator.paginate()
+        fields = ('DBInstanceArn', 'VpcSecurityGroups')
+        if index is not None:
+            fields += ('DBInstanceIdentifier', 'DBInstanceClass', 'Engine', 'EngineVersion', 'DBInstanceStatus',
+                       'TagList', 'DBSecurityGroups')
         classicrdsinstances = list()
-        for page in page_iterator:
-            for instance in page['DBInstances']:
-                if 'VpcSecurityGroups' not in instance.keys() or not instance['VpcSecurityGroups']:
-                    classicrdsinstances.append(instance['DBInstanceArn'])
+        for instance in fetchitems(rdsclient, 'describe_db_instances', ('DBInstances',), fields):
+            if 'VpcSecurityGroups' not in instance.keys() or not instance['VpcSecurityGroups']:
+                classicrdsinstances.append(instance['DBInstanceArn'])
+                if index is not None:
+                    index.addresource(currentregion, 'rds', instance['DBInstanceArn'],
+                                      pickattributes(instance, ('DBInstanceIdentifier', 'DBInstanceClass', 'Engine',
+                                                                'EngineVersion', 'DBInstanceStatus')),
+                                      instance.get('TagList'))
+                    for dbgroup in instance.get('DBSecurityGroups', ()):
+                        index.addedge(currentregion, 'rds', instance['DBInstanceArn'], 'uses', 'dbsecuritygroup',
+                                      dbgroup['DBSecurityGroupName'])
         return classicrdsinstances
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_db_instances in ' + currentregion + ' returned: ' + str(error))
@@ -316,15 +856,23 @@ def classicrds(rdsclient, errorfileobj, currentregion):
 # Get all Classic ElastiCache Clusters
 
 
-def classicelasticache(ecclient, errorfileobj, currentregion):
+def classicelasticache(ecclient, errorfileobj, currentregion, index=None):
     try:
-        paginator = ecclient.get_paginator('describe_cache_clusters')
-        page_iterator = paginator.paginate()
+        fields = ('ARN', 'CacheSubnetGroupName')
+        if index is not None:
+            fields += ('CacheClusterId', 'CacheNodeType', 'Engine', 'EngineVersion', 'CacheClusterStatus',
+                       'CacheSecurityGroups')
         classicecclusters = list()
-        for page in page_iterator:
-            for cluster in page['CacheClusters']:
-                if 'CacheSubnetGroupName' not in cluster.keys():
-                    classicecclusters.append(cluster['ARN'])
+        for cluster in fetchitems(ecclient, 'describe_cache_clusters', ('CacheClusters',), fields):
+            if 'CacheSubnetGroupName' not in cluster.keys():
+                classicecclusters.append(cluster['ARN'])
+                if index is not None:
+                    index.addresource(currentregion, 'elasticache', cluster['ARN'],
+                                      pickattributes(cluster, ('CacheClusterId', 'CacheNodeType', 'Engine',
+                                                               'EngineVersion', 'CacheClusterStatus')))
+                    for cachegroup in cluster.get('CacheSecurityGroups', ()):
+                        index.addedge(currentregion, 'elasticache', cluster['ARN'], 'uses', 'cachesecuritygroup',
+                                      cachegroup['CacheSecurityGroupName'])
         return classicecclusters
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_cache_clusters in ' + currentregion + ' returned: ' + str(error))
@@ -340,15 +888,22 @@ def classicelasticache(ecclient, errorfileobj, currentregion):
 # Get all Classic Redshift Clusters
 
 
-def classicredshift(rsclient, errorfileobj, currentregion):
+def classicredshift(rsclient, errorfileobj, currentregion, index=None):
     try:
-        paginator = rsclient.get_paginator('describe_clusters')
-        page_iterator = paginator.paginate()
+        fields = ('ClusterIdentifier', 'VpcId')
+        if index is not None:
+            fields += ('NodeType', 'NumberOfNodes', 'ClusterStatus', 'Tags', 'ClusterSecurityGroups')
         classicrsclusters = list()
-        for page in page_iterator:
-            for cluster in page['Clusters']:
-                if 'VpcId' not in cluster.keys():
-                    classicrsclusters.append(cluster['ClusterIdentifier'])
+        for cluster in fetchitems(rsclient, 'describe_clusters', ('Clusters',), fields):
+            if 'VpcId' not in cluster.keys():
+                classicrsclusters.append(cluster['ClusterIdentifier'])
+                if index is not None:
+                    index.addresource(currentregion, 'redshift', cluster['ClusterIdentifier'],
+                                      pickattributes(cluster, ('NodeType', 'NumberOfNodes', 'ClusterStatus')),
+                                      cluster.get('Tags'))
+                    for clustergroup in cluster.get('ClusterSecurityGroups', ()):
+                        index.addedge(currentregion, 'redshift', cluster['ClusterIdentifier'], 'uses',
+                                      'clustersecuritygroup', clustergroup['ClusterSecurityGroupName'])
         return classicrsclusters
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_clusters in ' + currentregion + ' returned: ' + str(error))
@@ -364,26 +919,32 @@ def classicredshift(rsclient, errorfileobj, currentregion):
 # Get all Classic ElasticBeanstalk Environments
 
 
-def classicbeanstalk(ebclient, errorfileobj, currentregion):
+def classicbeanstalk(ebclient, errorfileobj, currentregion, index=None):
     try:
-        paginator = ebclient.get_paginator('describe_environments')
         operation_parameters = {'IncludeDeleted': False}
-        page_iterator = paginator.paginate(**operation_parameters)
+        fields = ('ApplicationName', 'EnvironmentName')
+        if index is not None:
+            fields += ('EnvironmentId', 'SolutionStackName', 'Status', 'CNAME')
         ebclusters = list()
-        for page in page_iterator:
-            for environment in page['Environments']:
-                configsettings = ebclient.describe_configuration_settings(
-                    ApplicationName=environment['ApplicationName'],
-                    EnvironmentName=environment['EnvironmentName']
-                )
-                vpcset = False
-                for setting in configsettings['ConfigurationSettings']:
-                    for option in setting['OptionSettings']:
-                        if option['Namespace'] == 'aws:ec2:vpc' and option['OptionName'] == 'VPCId' and 'Value' in \
-                                option.keys():
-                            vpcset = True
-                if not vpcset:
-                    ebclusters.append(str(environment['ApplicationName'] + ', ' + environment['EnvironmentName']))
+        for environment in fetchitems(ebclient, 'describe_environments', ('Environments',), fields,
+                                      **operation_parameters):
+            configsettings = ebclient.describe_configuration_settings(
+                ApplicationName=environment['ApplicationName'],
+                EnvironmentName=environment['EnvironmentName']
+            )
+            vpcset = False
+            for setting in configsettings['ConfigurationSettings']:
+                for option in setting['OptionSettings']:
+                    if option['Namespace'] == 'aws:ec2:vpc' and option['OptionName'] == 'VPCId' and 'Value' in \
+                            option.keys():
+                        vpcset = True
+            configsettings = None
+            if not vpcset:
+                ebclusters.append(str(environment['ApplicationName'] + ', ' + environment['EnvironmentName']))
+                if index is not None:
+                    index.addresource(currentregion, 'elasticbeanstalk', ebclusters[-1],
+                                      pickattributes(environment, ('EnvironmentId', 'SolutionStackName', 'Status',
+                                                                   'CNAME')))
         return ebclusters
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('classicbeanstalk() in ' + currentregion + ' returned: ' + str(error))
@@ -399,7 +960,7 @@ def classicbeanstalk(ebclient, errorfileobj, currentregion):
 # Get all Classic Data Pipelines
 
 
-def classicdatapipelines(dpclient, errorfileobj, currentregion):
+def classicdatapipelines(dpclient, errorfileobj, currentregion, index=None):
     try:
         paginator = dpclient.get_paginator('list_pipelines')
         page_iterator = paginator.paginate()
@@ -421,6 +982,9 @@ def classicdatapipelines(dpclient, errorfileobj, currentregion):
                                 hasclassicresource = True
                 if hasclassicresource:
                     classicpipelines.append(pipeline['id'])
+                    if index is not None:
+                        index.addresource(currentregion, 'datapipeline', pipeline['id'],
+                                          pickattributes(pipeline, ('name',)))
         return classicpipelines
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('classicdatapipelines() in ' + currentregion + ' returned: ' + str(error))
@@ -436,7 +1000,7 @@ def classicdatapipelines(dpclient, errorfileobj, currentregion):
 # Get all Classic EMR Clusters
 
 
-def classicemr(emrclient, errorfileobj, currentregion):
+def classicemr(emrclient, errorfileobj, currentregion, index=None):
     try:
         paginator = emrclient.get_paginator('list_clusters')
         operation_parameters = {'ClusterStates': ['STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING']}
@@ -450,6 +1014,17 @@ def classicemr(emrclient, errorfileobj, currentregion):
                 if not clusterinfo['Cluster']['Ec2InstanceAttributes']['RequestedEc2SubnetIds'] and \
                         'Ec2SubnetId' not in clusterinfo['Cluster']['Ec2InstanceAttributes'].keys():
                     emrclusters.append(cluster['Id'])
+                    if index is not None:
+                        instanceattributes = clusterinfo['Cluster']['Ec2InstanceAttributes']
+                        attributes = pickattributes(clusterinfo['Cluster'], ('Name', 'ReleaseLabel'))
+                        if 'Status' in cluster:
+                            attributes['State'] = cluster['Status']['State']
+                        index.addresource(currentregion, 'emr', cluster['Id'], attributes,
+                                          clusterinfo['Cluster'].get('Tags'))
+                        for groupkey in ('EmrManagedMasterSecurityGroup', 'EmrManagedSlaveSecurityGroup'):
+                            if instanceattributes.get(groupkey):
+                                index.addedge(currentregion, 'emr', cluster['Id'], 'uses', 'securitygroup',
+                                              instanceattributes[groupkey])
         return emrclusters
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('classicemr() in ' + currentregion + ' returned: ' + str(error))
@@ -465,13 +1040,16 @@ def classicemr(emrclient, errorfileobj, currentregion):
 # Get OpsWorks Stacks with Classic Resources
 
 
-def classicopswork(owclient, errorfileobj, currentregion):
+def classicopswork(owclient, errorfileobj, currentregion, index=None):
     try:
         classicstacks = list()
         stacks = owclient.describe_stacks()
         for stack in stacks['Stacks']:
             if 'VpcId' not in stack.keys():
                 classicstacks.append(stack['StackId'])
+                if index is not None:
+                    index.addresource(currentregion, 'opsworks', stack['StackId'],
+                                      pickattributes(stack, ('Name', 'DefaultOs')))
         return classicstacks
     except botocore.exceptions.ClientError as error:
         errorfileobj.write('describe_stacks in ' + currentregion + ' returned: ' + str(error))
@@ -484,11 +1062,77 @@ def classicopswork(owclient, errorfileobj, currentregion):
         return ('UNKNOWN',)
 
 
-# Defines the main function on a per region level
-
-
-def getclassicresources(prefix, region, datapipelineregionlist, creds):
-    config = Config(
+# Classic checks in the order they are run. Each entry is the service name used in record output, the client the check
+# runs against, the check function, the regional CSV suffix and the progress message
+
+
+classicchecks = (
+    ('platform', 'ec2', classicplatformstatus, '_Classic_Platform_Status.csv',
+     'Checking the Classic platform status in '),
+    ('eip', 'ec2', classiceips, '_Classic_EIPs.csv',
+     'Checking for EIPs in '),
+    ('ec2', 'ec2', classicec2instances, '_Classic_EC2_Instances.csv',
+     'Checking for Classic EC2 Instances in '),
+    ('securitygroup', 'ec2', classicsecuritygroups, '_Classic_SGs.csv',
+     'Checking for Classic Security Groups in '),
+    ('classiclink', 'ec2', classiclinks, '_Classic_ClassicLink_VPCs.csv',
+     'Checking for VPCs with ClassicLink enabled in '),
+    ('autoscaling', 'autoscaling', classicasgs, '_Classic_Auto_Scaling_Groups.csv',
+     'Checking for AutoScaling Groups configured for Classic in '),
+    ('clb', 'elb', classicclbs, '_Classic_CLBs.csv',
+     'Checking for Classic Load Balancers running in EC2-Classic in '),
+    ('rds', 'rds', classicrds, '_Classic_RDS_Instances.csv',
+     'Checking for Classic RDS Instances in '),
+    ('elasticache', 'elasticache', classicelasticache, '_Classic_ElastiCache_Clusters.csv',
+     'Checking for Classic ElastiCache clusters in '),
+    ('redshift', 'redshift', classicredshift, '_Classic_Redshift_Clusters.csv',
+     'Checking for Classic Redshift clusters in '),
+    ('elasticbeanstalk', 'elasticbeanstalk', classicbeanstalk,
+     '_Classic_ElasticBeanstalk_Applications_Environments.csv',
+     'Checking for Classic Elastic BeanStalk Environments in '),
+    ('emr', 'emr', classicemr, '_Classic_EMR_Clusters.csv',
+     'Checking for Classic EMR clusters in '),
+    ('opsworks', 'opsworks', classicopswork, '_Classic_OpsWorks_Stacks.csv',
+     'Checking for Classic OpsWorks stacks in '),
+    ('datapipeline', 'datapipeline', classicdatapipelines, '_Classic_DataPipelines.csv',
+     'Checking for Classic Data Pipelines in '),
+)
+
+# Order the checks are run in triage mode, from the cheapest and most likely to find a Classic resource to the checks
+# which make a call per resource. Security Groups are not checked as every region with EC2-Classic enabled has a
+# default Classic Security Group
+
+triageorder = ('platform', 'eip', 'ec2', 'classiclink', 'clb', 'autoscaling', 'rds', 'elasticache', 'redshift',
+               'opsworks', 'elasticbeanstalk', 'emr', 'datapipeline')
+servicechecks = OrderedDict((servicename, (clientname, checkfunction, suffix, message))
+                            for servicename, clientname, checkfunction, suffix, message in classicchecks)
+
+# Base cost in seconds of each check and the additional cost per Classic resource found in the account, used to order
+# units of work which have no duration history. The checks which make a call per resource cost the most per resource
+
+servicecosts = {
+    'platform': (0.5, 0.0),
+    'eip': (0.5, 0.001),
+    'ec2': (1.0, 0.005),
+    'securitygroup': (1.0, 0.002),
+    'classiclink': (0.5, 0.001),
+    'autoscaling': (1.0, 0.005),
+    'clb': (1.0, 0.005),
+    'rds': (1.0, 0.005),
+    'elasticache': (1.0, 0.005),
+    'redshift': (1.0, 0.005),
+    'elasticbeanstalk': (2.0, 0.5),
+    'emr': (2.0, 0.3),
+    'opsworks': (0.5, 0.001),
+    'datapipeline': (2.0, 0.4),
+}
+
+
+# Creates the client configuration for a region
+
+
+def clientconfig(region):
+    return Config(
         region_name=region,
         retries={
             'max_attempts': 10,
@@ -496,8 +1140,12 @@ def getclassicresources(prefix, region, datapipelineregionlist, creds):
         }
     )
 
-    # Parse creds parameter to determine if using provided access creds, a cred profile or the default system creds.
 
+# Parse creds parameter to determine if using provided access creds, a cred profile or the default system creds.
+
+
+def createsession(creds):
+    importboto()
     if 'secretkey' not in creds.keys() and 'sessiontoken' not in creds.keys() and 'accesskey' not in creds.keys() and \
             'profile' not in creds.keys():
         session = boto3.session.Session()
@@ -516,286 +1164,727 @@ def getclassicresources(prefix, region, datapipelineregionlist, creds):
               'getclassicresources(). We proceeded using the system configured credentials. The keys included were: '
               '' + str(creds.keys()))
         session = boto3.session.Session()
+    return session
 
-    ec2obj = session.client('ec2', config=config)
-    asgobj = session.client('autoscaling', config=config)
-    elbobj = session.client('elb', config=config)
-    rdsobj = session.client('rds', config=config)
-    ecobj = session.client('elasticache', config=config)
-    rsobj = session.client('redshift', config=config)
-    ebobj = session.client('elasticbeanstalk', config=config)
-    emrobj = session.client('emr', config=config)
-    owobj = session.client('opsworks', config=config)
 
-    errorfile = open(prefix + region + '_errors.txt', 'a')
+# Sessions and clients are kept for the life of a worker process, so the units of work for an account reuse them.
+# Only the most recently used are kept to bound the memory used by workers over a large organization
+
+sessioncache = OrderedDict()
+clientcache = OrderedDict()
+sessioncachesize = 16
+clientcachesize = 64
+
+
+def getclient(creds, region, clientname):
+    credskey = tuple(sorted(creds.items()))
+    clientkey = (credskey, region, clientname)
+    if clientkey in clientcache:
+        clientcache.move_to_end(clientkey)
+        return clientcache[clientkey]
+    if credskey in sessioncache:
+        sessioncache.move_to_end(credskey)
+    else:
+        sessioncache[credskey] = createsession(creds)
+        if len(sessioncache) > sessioncachesize:
+            sessioncache.popitem(last=False)
+    clientcache[clientkey] = sessioncache[credskey].client(clientname, config=clientconfig(region))
+    if len(clientcache) > clientcachesize:
+        clientcache.popitem(last=False)
+    return clientcache[clientkey]
+
+
+# Runs a single check for an account and region and returns the number of Classic resources found with the records
+# built from the check, which are empty when the output only needs the CSVs
 
-    # Classic Platform Status
-    print('Checking the Classic platform status in ' + region)
 
-    platformfile = open(prefix + region + '_Classic_Platform_Status.csv', 'a')
+def getclassicresources(prefix, region, servicename, creds, accountid, options):
+    clientname, checkfunction, suffix, message = servicechecks[servicename]
+    scanlimits['pagesizes'] = options['pagesizes']
+    scanlimits['memorycap'] = options['memorycap']
+    errorfile = open(prefix + region + '_' + servicename + '_errors.txt', 'a')
     try:
-        platformfile.write(region + ', ' + classicplatformstatus(ec2obj, errorfile, region) + '\n')
-    except Exception as e:
-        errorfile.write('Platform Status for ' + region + ' failed to write. Error: ' + str(e))
+        print(message + region)
+        if 'graph' in options:
+            index = ResourceIndex()
+        else:
+            index = None
+        result = checkfunction(getclient(creds, region, clientname), errorfile, region, index)
+        records = list()
+        if options['format'] != 'csv' or 'sqlite' in options or 'serve' in options:
+            records = buildrecords(accountid, region, servicename, result)
+        if options['format'] == 'csv' and 'serve' not in options:
+            if isinstance(result, str):
+                filewriter(prefix, errorfile, [result], region, suffix)
+            else:
+                filewriter(prefix, errorfile, result, region, suffix)
+        elif options['format'] in runfilesuffixes:
+            recordpartwriter(prefix + region + '_' + servicename + '_records.jsonl.gz', errorfile, records, region)
+        if index is not None:
+            try:
+                index.save(prefix + region + '_' + servicename + '_graph.json')
+            except Exception as e:
+                errorfile.write('Resource index for ' + servicename + ' in ' + region + ' failed to write. Error: ' +
+                                str(e))
     finally:
-        platformfile.close()
+        errorfile.close()
+    if isinstance(result, str) or tuple(result) == ('UNKNOWN',):
+        return 0, records
+    return len(result), records
 
-    # Classic EIPs
-    print('Checking for EIPs in ' + region)
-    filewriter(prefix, errorfile, classiceips(ec2obj, errorfile, region), region, '_Classic_EIPs.csv')
 
-    # Classic EC2 Instances
-    print('Checking for Classic EC2 Instances in ' + region)
-    filewriter(prefix, errorfile, classicec2instances(ec2obj, errorfile, region), region, '_Classic_EC2_Instances.csv')
+# Runs a unit of work in a worker process and returns how long it took with the number of Classic resources found,
+# and whether the worker is over its memory cap. The records are only returned to the parent process in service mode,
+# where they are kept in memory, or to be written to the results database for the whole account at once
 
-    # Classic Security Groups
-    print('Checking for Classic Security Groups in ' + region)
-    filewriter(prefix, errorfile, classicsecuritygroups(ec2obj, errorfile, region), region, '_Classic_SGs.csv')
 
-    # ClassicLink VPCs
-    print('Checking for VPCs with ClassicLink enabled in ' + region)
-    filewriter(prefix, errorfile, classiclinks(ec2obj, errorfile, region), region, '_Classic_ClassicLink_VPCs.csv')
+def timedunit(prefix, region, servicename, creds, accountid, options):
+    starttime = time.monotonic()
+    resourcecount, records = getclassicresources(prefix, region, servicename, creds, accountid, options)
+    if 'serve' not in options and 'sqlite' not in options:
+        records = None
+    return time.monotonic() - starttime, resourcecount, records, overmemorycap()
 
-    # Classic Auto Scaling Groups
-    print('Checking for AutoScaling Groups configured for Classic in ' + region)
-    filewriter(prefix, errorfile, classicasgs(asgobj, errorfile, region), region, '_Classic_Auto_Scaling_Groups.csv')
 
-    # Classic CLBs
-    print('Checking for Classic Load Balancers running in EC2-Classic in ' + region)
-    filewriter(prefix, errorfile, classicclbs(elbobj, errorfile, region), region, '_Classic_CLBs.csv')
+# Runs the triage checks for a region, stopping at the first Classic resource found in any region of the account. A
+# check which raises an error leaves the account unknown rather than stopping the region
 
-    # Classic RDS Instances
-    print('Checking for Classic RDS Instances in ' + region)
-    filewriter(prefix, errorfile, classicrds(rdsobj, errorfile, region), region, '_Classic_RDS_Instances.csv')
 
-    # Classic ElastiCache Clusters
-    print('Checking for Classic ElastiCache clusters in ' + region)
-    filewriter(prefix, errorfile, classicelasticache(ecobj, errorfile, region), region,
-               '_Classic_ElastiCache_Clusters.csv')
+def triageclassicresources(prefix, region, servicenames, creds, foundflag, unknownflag):
+    errorfile = open(prefix + region + '_errors.txt', 'a')
+    try:
+        for servicename in servicenames:
+            if foundflag.value:
+                break
+            clientname, checkfunction, suffix, message = servicechecks[servicename]
+            print(message + region)
+            try:
+                result = checkfunction(getclient(creds, region, clientname), errorfile, region)
+            except Exception as e:
+                errorfile.write(servicename + ' check in ' + region + ' failed. Error: ' + str(e))
+                unknownflag.value = 1
+                continue
+            if servicename == 'platform':
+                if result == 'Disabled':
+                    # Resources cannot be launched into EC2-Classic in regions where the platform is disabled
+                    break
+                elif result == 'UNKNOWN':
+                    unknownflag.value = 1
+            elif tuple(result) == ('UNKNOWN',):
+                unknownflag.value = 1
+            elif result:
+                foundflag.value = 1
+    finally:
+        errorfile.close()
+
+
+# Spawns a triage process for each region and cancels the remaining regions once a Classic resource is found. The
+# flags shared with the region processes have no lock, so a process stopped part way through a check cannot leave a
+# lock held. Region processes stop on their own before their next check, and any still running a check after a
+# second are terminated. A region process which exits with an error without being terminated leaves the account
+# unknown
+
+
+def triageregions(scanplan, creds, executionprefix):
+    foundflag = Value('b', 0, lock=False)
+    unknownflag = Value('b', 0, lock=False)
+    processes = []
+    for regionname in scanplan['regions']:
+        servicenames = [servicename for servicename in triageorder if (regionname, servicename) in scanplan['units']]
+        process = Process(target=triageclassicresources, args=(executionprefix, regionname, servicenames, creds,
+                                                               foundflag, unknownflag))
+        processes.append(process)
+    for process in processes:
+        process.start()
+    while any(process.is_alive() for process in processes) and not foundflag.value:
+        time.sleep(0.1)
+    stoptime = time.monotonic() + 1
+    regionfailed = False
+    for process in processes:
+        process.join(max(0, stoptime - time.monotonic()))
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        elif process.exitcode != 0:
+            regionfailed = True
+    concatenateerrors(scanplan['regions'], executionprefix)
+    if foundflag.value:
+        return 'yes'
+    elif unknownflag.value or regionfailed:
+        return 'unknown'
+    else:
+        return 'no'
+
+
+# Assumes the role for each account and caches the credentials until they are close to expiring
+
+
+class CredentialCache:
+    def __init__(self, refreshseconds=900):
+        self.refreshseconds = refreshseconds
+        self.stsclient = None
+        self.credentials = dict()
+
+    def get(self, credsource):
+        if 'rolearn' not in credsource:
+            return credsource
+        cached = self.credentials.get(credsource['rolearn'])
+        if cached is not None and \
+                (cached['expiration'] - datetime.now(timezone.utc)).total_seconds() > self.refreshseconds:
+            return cached['creds']
+        if self.stsclient is None:
+            importboto()
+            self.stsclient = boto3.client('sts')
+        assumeroleparameters = {
+            'RoleArn': credsource['rolearn'],
+            'RoleSessionName': 'ec2-classic-resource-finder',
+            'DurationSeconds': 3600
+        }
+        if 'externalid' in credsource:
+            assumeroleparameters['ExternalId'] = credsource['externalid']
+        accountstscred = self.stsclient.assume_role(**assumeroleparameters)
+        creds = {
+            'accesskey': accountstscred['Credentials']['AccessKeyId'],
+            'secretkey': accountstscred['Credentials']['SecretAccessKey'],
+            'sessiontoken': accountstscred['Credentials']['SessionToken']
+        }
+        self.credentials[credsource['rolearn']] = {'creds': creds,
+                                                   'expiration': accountstscred['Credentials']['Expiration']}
+        return creds
 
-    # Classic Redshift Clusters
-    print('Checking for Classic Redshift clusters in ' + region)
-    filewriter(prefix, errorfile, classicredshift(rsobj, errorfile, region), region, '_Classic_Redshift_Clusters.csv')
 
-    # Classic Elastic Beanstalk Environments
-    print('Checking for Classic Elastic BeanStalk Environments in ' + region)
-    filewriter(prefix, errorfile, classicbeanstalk(ebobj, errorfile, region), region,
-               '_Classic_ElasticBeanstalk_Applications_Environments.csv')
+# Gets the account ID for a set of credentials, unless it is already known, and the output prefix for the account
 
-    # classic EMR Clusters
-    print('Checking for Classic EMR clusters in ' + region)
-    filewriter(prefix, errorfile, classicemr(emrobj, errorfile, region), region, '_Classic_EMR_Clusters.csv')
 
-    # Classic OpsWorks Stacks
-    print('Checking for Classic OpsWorks stacks in ' + region)
-    filewriter(prefix, errorfile, classicopswork(owobj, errorfile, region), region, '_Classic_OpsWorks_Stacks.csv')
+def resolveaccount(creds, accountid=None):
+    if accountid is None:
+        session = createsession(creds)
+        sts = session.client('sts')
+        accountid = sts.get_caller_identity()['Account']
+    executiontime = datetime.now()
+    executionprefix = accountid + '/' + executiontime.strftime("%d-%m-%Y-%H-%M-%S_")
+    return accountid, executiontime, executionprefix
 
-    # Classic Data Pipelines
-    if region in datapipelineregionlist:
-        print('Checking for Classic Data Pipelines in ' + region)
-        dpobj = session.client('datapipeline', config=config)
-        filewriter(prefix, errorfile, classicdatapipelines(dpobj, errorfile, region), region,
-                   '_Classic_DataPipelines.csv')
 
-    errorfile.close()
+# Loads the duration history of previous runs. Each entry is keyed by account/region/service and holds the smoothed
+# duration in seconds and the number of Classic resources found
 
 
-# Loop through regions and spawn a process for each region
+def loadhistory(historyfile):
+    if not os.path.exists(historyfile):
+        return dict()
+    try:
+        with open(historyfile, 'r') as readfile:
+            return json.load(readfile)
+    except (OSError, ValueError) as e:
+        print('Could not read the scan history from ' + historyfile + ', units will be ordered by their estimated '
+              'cost. The error was: ' + str(e))
+        return dict()
 
 
-def loopregions(classicregionslist, datapipelineregionslist, creds):
-    executionprefix = datetime.now()
-    executionprefix = executionprefix.strftime("%d-%m-%Y-%H-%M-%S_")
+# Saves the duration history for the next run
 
-    if 'secretkey' not in creds.keys() and 'sessiontoken' not in creds.keys() and 'accesskey' not in creds.keys() and \
-            'profile' not in creds.keys():
-        # Default invocation detected
-        session = boto3.session.Session()
-        sts = session.client('sts')
-        accountid = sts.get_caller_identity()
-        executionprefix = accountid['Account'] + '/' + executionprefix
-        if not os.path.exists(accountid['Account']):
-            os.mkdir(accountid['Account'])
-        processes = []
-        for regionname in classicregionslist:
-            processobj = Process(target=getclassicresources, args=(executionprefix, regionname,
-                                                                datapipelineregionslist, {}))
-            processes.append(processobj)
-        for process in processes:
-            process.start()
-        for process in processes:
-            process.join()
-        concatenateregions(classicregionslist, datapipelineregionslist, executionprefix)
-        return True
-    elif 'secretkey' in creds.keys() and 'sessiontoken' in creds.keys() and 'accesskey' in creds.keys():
-        # Organizational invocation detected
-        session = boto3.session.Session(
-            aws_access_key_id=creds['accesskey'],
-            aws_secret_access_key=creds['secretkey'],
-            aws_session_token=creds['sessiontoken']
-        )
-        sts = session.client('sts')
-        accountid = sts.get_caller_identity()
-        executionprefix = accountid['Account'] + '/' + executionprefix
-        if not os.path.exists(accountid['Account']):
-            os.mkdir(accountid['Account'])
-        processes = []
-        for regionname in classicregionslist:
-            process = Process(target=getclassicresources, args=(executionprefix, regionname,
-                                                                datapipelineregionslist,
-                                                                creds))
-            processes.append(process)
-        for process in processes:
-            process.start()
-        for process in processes:
-            process.join()
-        concatenateregions(classicregionslist, datapipelineregionslist, executionprefix)
-        return True
-    elif 'profile' in creds.keys():
-        # Profile invocation detected
-        session = boto3.session.Session(
-            profile_name=creds['profile']
-        )
-        sts = session.client('sts')
-        accountid = sts.get_caller_identity()
-        executionprefix = accountid['Account'] + '/' + executionprefix
-        if not os.path.exists(accountid['Account']):
-            os.mkdir(accountid['Account'])
-        processes = []
-        for regionname in classicregionslist:
-            process = Process(target=getclassicresources, args=(executionprefix, regionname,
-                                                                datapipelineregionslist, creds))
-            processes.append(process)
-        for process in processes:
-            process.start()
-        for process in processes:
-            process.join()
-        concatenateregions(classicregionslist, datapipelineregionslist, executionprefix)
-        return True
-    else:
-        print('We received a partial authentication session but not all attributes included when calling '
-              'getclassicresources(). We proceeded using the system configured credentials. The keys included were: '
-              '' + str(creds.keys()))
-        session = boto3.session.Session()
-        sts = session.client('sts')
-        accountid = sts.get_caller_identity()
-        executionprefix = accountid['Account'] + '/' + executionprefix
-        if not os.path.exists(accountid['Account']):
-            os.mkdir(accountid['Account'])
-        processes = []
-        for regionname in classicregionslist:
-            process = Process(target=getclassicresources, args=(executionprefix, regionname,
-                                                                datapipelineregionslist, {}))
-            processes.append(process)
-            for process in processes:
-                process.start()
-            for process in processes:
-                process.join()
-        concatenateregions(classicregionslist, datapipelineregionslist, executionprefix)
-        return True
 
+def savehistory(historyfile, history):
+    try:
+        with open(historyfile + '.tmp', 'w') as writefile:
+            json.dump(history, writefile, separators=(',', ':'))
+        os.replace(historyfile + '.tmp', historyfile)
+    except OSError as e:
+        print('Could not save the scan history to ' + historyfile + '. The error was: ' + str(e))
 
-# Concatenates all regional files into single file per service
 
+# Records how long a unit of work took, smoothing it with the previous runs
 
-def concatenateregions(classicregionslist, datapipelineregionslist, executionprefix):
-    platformoutput = open(executionprefix + 'Classic_Platform_Status.csv', 'a')
-    eipoutput = open(executionprefix + 'Classic_EIPs.csv', 'a')
-    ec2output = open(executionprefix + 'Classic_EC2_Instances.csv', 'a')
-    sgoutput = open(executionprefix + 'Classic_SGs.csv', 'a')
-    clvpcoutput = open(executionprefix + 'Classic_ClassicLink_VPCs.csv', 'a')
-    asgoutput = open(executionprefix + 'Classic_Auto_Scaling_Groups.csv', 'a')
-    clboutput = open(executionprefix + 'Classic_CLBs.csv', 'a')
-    rdsoutput = open(executionprefix + 'Classic_RDS_Instances.csv', 'a')
-    ecoutput = open(executionprefix + 'Classic_ElastiCache_Clusters.csv', 'a')
-    rsoutput = open(executionprefix + 'Classic_Redshift_Clusters.csv', 'a')
-    eboutput = open(executionprefix + 'Classic_ElasticBeanstalk_Applications_Environments.csv', 'a')
-    emroutput = open(executionprefix + 'Classic_EMR_Clusters.csv', 'a')
-    owoutput = open(executionprefix + 'Classic_OpsWorks_Stacks.csv', 'a')
-    dpoutput = open(executionprefix + 'Classic_DataPipelines.csv', 'a')
-    erroroutput = open(executionprefix + 'Errors.txt', 'a')
 
-    for regionname in classicregionslist:
+def updatehistory(history, accountid, region, servicename, duration, resourcecount):
+    historykey = accountid + '/' + region + '/' + servicename
+    if historykey in history:
+        duration = (history[historykey][0] + duration) / 2
+    history[historykey] = [round(duration, 3), resourcecount]
 
-        # Platform Status concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_Platform_Status.csv', platformoutput)
 
-        # EIP Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_EIPs.csv', eipoutput)
+# Highest number of Classic resources found for each account and service in any region, used to estimate units of
+# work without a duration history of their own
 
-        # EC2 Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_EC2_Instances.csv', ec2output)
 
-        # SG Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_SGs.csv', sgoutput)
+def historyresourcecounts(history):
+    resourcecounts = dict()
+    for historykey, (duration, resourcecount) in history.items():
+        accountid, region, servicename = historykey.split('/')
+        if resourcecount > resourcecounts.get((accountid, servicename), 0):
+            resourcecounts[(accountid, servicename)] = resourcecount
+    return resourcecounts
 
-        # ClassicLink Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_ClassicLink_VPCs.csv', clvpcoutput)
 
-        # ASG Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_Auto_Scaling_Groups.csv', asgoutput)
+# Expected duration of a unit of work, from its history if it has one and from the service cost otherwise. Only the
+# counts of earlier runs are used, as the longest units of an account run before the cheap checks that would show its
+# size, so on a first run every account has the same estimate
 
-        # CLB Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_CLBs.csv', clboutput)
 
-        # RDS Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_RDS_Instances.csv', rdsoutput)
+def expectedduration(history, resourcecounts, accountid, region, servicename):
+    historyentry = history.get(accountid + '/' + region + '/' + servicename)
+    if historyentry is not None:
+        return historyentry[0]
+    basecost, resourcecost = servicecosts[servicename]
+    return basecost + resourcecost * resourcecounts.get((accountid, servicename), 0)
 
-        # ElastiCache Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_ElastiCache_Clusters.csv', ecoutput)
 
-        # Redshift Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_Redshift_Clusters.csv', rsoutput)
+# Pool of worker processes for the units of work. Memory freed by a worker is rarely returned to the operating system,
+# so when a worker reports it is over its memory cap the pool is replaced. Replacing the pool also drops the sessions
+# and clients every other worker holds, so it is replaced for the memory cap at most once every capinterval seconds.
+# Units already running finish in the old pool, whose processes exit once they are done. The pool is also replaced
+# straight away when a worker process dies, as the executor cannot be used again after that
 
-        # Elastic Beanstalk Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_ElasticBeanstalk_Applications_Environments.csv',
-                         eboutput)
 
-        # EMR Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_EMR_Clusters.csv', emroutput)
+class WorkerPool:
+    def __init__(self, workers, capinterval=300):
+        self.workers = workers
+        self.capinterval = capinterval
+        self.generation = 0
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.recycletime = time.monotonic()
 
-        # OpsWorks Concatenate
-        fileconcatenator(executionprefix, regionname, '_Classic_OpsWorks_Stacks.csv', owoutput)
+    def submit(self, *args):
+        try:
+            return self.executor.submit(*args)
+        except BrokenProcessPool:
+            self.recycle(self.generation)
+            return self.executor.submit(*args)
 
-        # Datapipelines Concatenate
-        if regionname in datapipelineregionslist:
-            fileconcatenator(executionprefix, regionname, '_Classic_DataPipelines.csv', dpoutput)
+    def recycle(self, generation):
+        # Several units of the same pool can report they are over the cap or lost, but the pool is only replaced once
+        if generation == self.generation:
+            self.executor.shutdown(wait=False)
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            self.generation += 1
+            self.recycletime = time.monotonic()
 
-        # Errors Concatenate
-        fileconcatenator(executionprefix, regionname, '_errors.txt', erroroutput)
+    def overcap(self, generation):
+        if time.monotonic() - self.recycletime >= self.capinterval:
+            self.recycle(generation)
 
-    platformoutput.close()
-    eipoutput.close()
-    ec2output.close()
-    sgoutput.close()
-    clvpcoutput.close()
-    asgoutput.close()
-    clboutput.close()
-    rdsoutput.close()
-    ecoutput.close()
-    rsoutput.close()
-    eboutput.close()
-    emroutput.close()
-    owoutput.close()
-    dpoutput.close()
-    erroroutput.close()
+    def shutdown(self):
+        self.executor.shutdown()
 
 
-# Main Function
-def main(argresult):
-    classicregions = ('us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1', 'ap-southeast-1', 'ap-southeast-2',
-                      'ap-northeast-1', 'sa-east-1',)
-    datapipelineregions = ('us-east-1', 'eu-west-1', 'ap-northeast-1', 'us-west-2', 'ap-southeast-2')
+# Concatenates the outputs of an account once all of its units of work have finished
 
-    creddict = {}
 
+def finishaccount(account, scanplan, options, runwriter, resultview):
+    if options['format'] == 'csv' and 'serve' not in options:
+        concatenateregions(scanplan, account['prefix'])
+    elif options['format'] in runfilesuffixes:
+        concatenaterecords(scanplan['regions'], account['prefix'], runwriter)
+    if resultview is not None:
+        resultview.update(account['accountid'], account['scantime'], account['records'])
+    if 'graph' in options:
+        if 'serve' in options:
+            # Service mode only keeps the graph of the latest scan of each account
+            concatenategraph(scanplan['regions'], account['prefix'], account['accountid'] + '/', 'w')
+        else:
+            concatenategraph(scanplan['regions'], account['prefix'], account['prefix'], 'a')
+    concatenateerrors(scanplan['regions'], account['prefix'])
+    if 'sqlite' in options:
+        erroroutput = open(account['prefix'] + 'Errors.txt', 'a')
+        databasewriter(options['sqlite'], erroroutput, account['scantime'], account['accountid'], account['checks'],
+                       account['records'])
+        erroroutput.close()
+    if 'serve' in options:
+        rollerrors(account['prefix'], account['accountid'], account['scantime'])
+    account['records'] = list()
+    account['checks'] = list()
+    print('Finished checking account ' + account['accountid'])
+
+
+# Splits every account into a unit of work per region and service, and runs them on a pool of worker processes.
+# Accounts are started longest expected duration first, and the units of the accounts started are run longest
+# expected duration first, so the short units fill in at the end of the run rather than the run ending on one large
+# account. Only as many accounts as there are workers are started at once, and another is only started early when
+# a worker would otherwise be idle, so each account finishes and concatenates its part files soon after it starts.
+# Units lost because a worker process died are run again one at a time, as most of them were only running alongside
+# the unit that killed it, and a unit that stops its worker again on its own is reported as failed. Service mode
+# passes in the worker pool and the duration history it keeps between scans
+
+
+def scanaccounts(targets, scanplan, options, runwriter, credentialcache, workerpool=None, resultview=None,
+                 history=None):
+    ownhistory = history is None
+    if ownhistory:
+        history = loadhistory(options['history'])
+    resourcecounts = historyresourcecounts(history)
+    accounts = list()
+
+    for targettype, targetname, credsource in targets:
+        try:
+            if targettype == 'account':
+                # The account ID of organization accounts is already known, so the role is only assumed when the
+                # first unit of work for the account is submitted
+                accountid, executiontime, executionprefix = resolveaccount(None, targetname)
+            else:
+                accountid, executiontime, executionprefix = resolveaccount(credentialcache.get(credsource))
+        except Exception as e:
+            print('Error running for ' + targettype + ' ' + str(targetname) + '. The error was: ' + str(e))
+            continue
+        account = {
+            'accountid': accountid,
+            'prefix': executionprefix,
+            'scantime': executiontime.isoformat(timespec='seconds'),
+            'credsource': credsource,
+            'started': False,
+            'failed': False,
+            'units': list(),
+            'pending': 0,
+            'records': list(),
+            'checks': list()
+        }
+        for regionname, servicename in scanplan['units']:
+            account['units'].append((expectedduration(history, resourcecounts, accountid, regionname, servicename),
+                                     regionname, servicename))
+        account['pending'] = len(account['units'])
+        accounts.append(account)
+
+    accounts.sort(key=lambda account: sum(unit[0] for unit in account['units']), reverse=True)
+
+    # Units are submitted as workers become free, so the credentials for each unit are refreshed if they are expiring
+    inflight = dict()
+    pendingunits = list()
+    retryunits = list()
+    nextaccount = 0
+    activeaccounts = 0
+    ownworkerpool = workerpool is None
+    if ownworkerpool:
+        workerpool = WorkerPool(options['workers'])
+    try:
+        while nextaccount < len(accounts) or pendingunits or retryunits or inflight:
+            while len(inflight) < options['workers'] and (nextaccount < len(accounts) or pendingunits or retryunits):
+                # A unit lost with a worker process waits for the running units to finish, and nothing else is
+                # started until it has finished
+                retrying = bool(retryunits)
+                if any(unit[4] for unit in inflight.values()) or (retrying and inflight):
+                    break
+                if retrying:
+                    accountindex, regionname, servicename = retryunits.pop()
+                elif nextaccount < len(accounts) and (activeaccounts < options['workers'] or not pendingunits):
+                    account = accounts[nextaccount]
+                    for expected, regionname, servicename in account['units']:
+                        heapq.heappush(pendingunits, (-expected, nextaccount, regionname, servicename))
+                    if account['units']:
+                        activeaccounts += 1
+                    nextaccount += 1
+                    continue
+                else:
+                    expected, accountindex, regionname, servicename = heapq.heappop(pendingunits)
+                account = accounts[accountindex]
+                creds = None
+                if not account['failed']:
+                    try:
+                        creds = credentialcache.get(account['credsource'])
+                    except Exception as e:
+                        # The remaining units of an account are skipped once its credentials cannot be fetched
+                        print('Error running for account ' + account['accountid'] + '. The error was: ' + str(e))
+                        account['failed'] = True
+                if creds is not None:
+                    if not account['started']:
+                        if not os.path.exists(account['accountid']):
+                            os.mkdir(account['accountid'])
+                        account['started'] = True
+                    try:
+                        future = workerpool.submit(timedunit, account['prefix'], regionname, servicename, creds,
+                                                   account['accountid'], options)
+                        inflight[future] = (accountindex, regionname, servicename, workerpool.generation, retrying)
+                        continue
+                    except Exception as e:
+                        print('Error running ' + servicename + ' in ' + regionname + ' for account ' +
+                              account['accountid'] + '. The error was: ' + str(e))
+                account['pending'] -= 1
+                if account['pending'] == 0:
+                    activeaccounts -= 1
+                    if account['started']:
+                        finishaccount(account, scanplan, options, runwriter, resultview)
+            if not inflight:
+                continue
+            done, notdone = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                accountindex, regionname, servicename, generation, retrying = inflight.pop(future)
+                account = accounts[accountindex]
+                try:
+                    duration, resourcecount, records, overcap = future.result()
+                    if overcap:
+                        workerpool.overcap(generation)
+                    updatehistory(history, account['accountid'], regionname, servicename, duration,
+                                  resourcecount)
+                    account['checks'].append((regionname, servicename))
+                    if records:
+                        account['records'].extend(records)
+                except BrokenProcessPool as e:
+                    workerpool.recycle(generation)
+                    if not retrying:
+                        retryunits.append((accountindex, regionname, servicename))
+                        continue
+                    print('Error running ' + servicename + ' in ' + regionname + ' for account ' +
+                          account['accountid'] + '. The worker process stopped while running it on its own. The '
+                          'error was: ' + str(e))
+                except Exception as e:
+                    print('Error running ' + servicename + ' in ' + regionname + ' for account ' +
+                          account['accountid'] + '. The error was: ' + str(e))
+                account['pending'] -= 1
+                if account['pending'] == 0:
+                    activeaccounts -= 1
+                    finishaccount(account, scanplan, options, runwriter, resultview)
+    finally:
+        if ownworkerpool:
+            workerpool.shutdown()
+        if ownhistory:
+            savehistory(options['history'], history)
+
+
+# Results of a single account in a ResultStore. Each column is an array of codes into the dictionaries of the store,
+# and the resource IDs are kept as one UTF-8 byte string with the offset where each one ends. The number of Classic
+# resources of each service is kept by service code as the records are added
+
+
+class AccountResults:
+    __slots__ = ('scantime', 'regions', 'services', 'statuses', 'resourceids', 'offsets', 'counts')
+
+    def __init__(self, scantime):
+        self.scantime = scantime
+        self.regions = array('H')
+        self.services = array('H')
+        self.statuses = array('H')
+        self.resourceids = bytearray()
+        self.offsets = array('I')
+        self.counts = array('I')
+
+
+# Compact store of the results of many accounts, used to summarise and compare organization wide results. Region,
+# service and status names are dictionary encoded and account IDs and scan times are interned, so each record costs
+# a few bytes and its resource ID rather than a dictionary of strings
+
+
+class ResultStore:
+    def __init__(self):
+        self.accounts = dict()
+        self.values = {column: list() for column in ('region', 'service', 'status')}
+        self.codes = {column: dict() for column in ('region', 'service', 'status')}
+
+    def encode(self, column, value):
+        codes = self.codes[column]
+        if value not in codes:
+            codes[value] = len(self.values[column])
+            self.values[column].append(value)
+        return codes[value]
+
+    def addaccount(self, accountid, scantime):
+        accountresults = AccountResults(sys.intern(scantime))
+        self.accounts[sys.intern(accountid)] = accountresults
+        return accountresults
+
+    def addrecord(self, accountresults, region, servicename, resourceid, status):
+        servicecode = self.encode('service', servicename)
+        accountresults.regions.append(self.encode('region', region))
+        accountresults.services.append(servicecode)
+        accountresults.statuses.append(self.encode('status', status))
+        accountresults.resourceids.extend(resourceid.encode('utf-8'))
+        accountresults.offsets.append(len(accountresults.resourceids))
+        if status == 'Classic':
+            if servicecode >= len(accountresults.counts):
+                accountresults.counts.extend([0] * (servicecode + 1 - len(accountresults.counts)))
+            accountresults.counts[servicecode] += 1
+
+    def replace(self, accountid, scantime, recordlist):
+        accountresults = self.addaccount(accountid, scantime)
+        for record in recordlist:
+            self.addrecord(accountresults, record['region'], record['service'], record['resourceid'],
+                           record['status'])
+
+    def records(self, accountid):
+        accountresults = self.accounts[accountid]
+        regions = self.values['region']
+        services = self.values['service']
+        statuses = self.values['status']
+        start = 0
+        for row, end in enumerate(accountresults.offsets):
+            yield (regions[accountresults.regions[row]], services[accountresults.services[row]],
+                   accountresults.resourceids[start:end].decode('utf-8'), statuses[accountresults.statuses[row]])
+            start = end
+
+    # Only the Classic resources of the service are decoded, found by comparing codes
+
+    def classicresources(self, accountid, servicename):
+        accountresults = self.accounts[accountid]
+        servicecode = self.codes['service'].get(servicename)
+        classiccode = self.codes['status'].get('Classic')
+        regions = self.values['region']
+        for row, (recordservice, statuscode) in enumerate(zip(accountresults.services, accountresults.statuses)):
+            if recordservice == servicecode and statuscode == classiccode:
+                start = accountresults.offsets[row - 1] if row else 0
+                yield (regions[accountresults.regions[row]],
+                       accountresults.resourceids[start:accountresults.offsets[row]].decode('utf-8'))
+
+    def classiccounts(self, accountid):
+        services = self.values['service']
+        return {services[servicecode]: count for servicecode, count in enumerate(self.accounts[accountid].counts)
+                if count}
+
+    def classictotal(self, accountid):
+        return sum(self.accounts[accountid].counts)
+
+    def summary(self):
+        servicesummary = dict()
+        accountswithclassic = 0
+        for accountid in self.accounts:
+            counts = self.classiccounts(accountid)
+            if counts:
+                accountswithclassic += 1
+            for servicename, count in counts.items():
+                servicetotals = servicesummary.setdefault(servicename, {'accounts': 0, 'classicresources': 0})
+                servicetotals['accounts'] += 1
+                servicetotals['classicresources'] += count
+        scantimes = [accountresults.scantime for accountresults in self.accounts.values() if accountresults.scantime]
+        return {
+            'accounts': len(self.accounts),
+            'accountswithclassic': accountswithclassic,
+            'oldestscan': min(scantimes, default=None),
+            'newestscan': max(scantimes, default=None),
+            'services': servicesummary
+        }
+
+    # Records of an account grouped by the region and service check that found them. The Not found record of a check
+    # only marks that it was run
+
+    def checkrecords(self, accountid):
+        checks = dict()
+        for region, servicename, resourceid, status in self.records(accountid):
+            records = checks.setdefault((region, servicename), set())
+            if status != 'Not found':
+                records.add((region, servicename, resourceid, status))
+        return checks
+
+    # Records are only decoded one account at a time, so comparing two stores does not build a set of every record.
+    # Only the checks run in both stores are compared, and checks which failed in either are skipped, so a run of
+    # fewer services or regions, or a check which failed, is not reported as its resources being removed
+
+    def diff(self, previous):
+        for accountid in self.accounts:
+            currentchecks = self.checkrecords(accountid)
+            previouschecks = previous.checkrecords(accountid) if accountid in previous.accounts else None
+            added = list()
+            removed = list()
+            for (region, servicename), currentrecords in currentchecks.items():
+                if previouschecks is None:
+                    previousrecords = set()
+                elif (region, servicename) in previouschecks:
+                    previousrecords = previouschecks[(region, servicename)]
+                    unknownrecord = (region, servicename, '', 'UNKNOWN')
+                    if unknownrecord in currentrecords or unknownrecord in previousrecords:
+                        continue
+                else:
+                    continue
+                added.extend(currentrecords - previousrecords)
+                removed.extend(previousrecords - currentrecords)
+            for record in sorted(added):
+                yield (accountid,) + record + ('Added',)
+            for record in sorted(removed):
+                yield (accountid,) + record + ('Removed',)
+        for accountid in previous.accounts:
+            if accountid not in self.accounts:
+                yield accountid, '', '', '', '', 'Not scanned'
+
+
+# Latest results of each account held in memory by the service mode. Accounts are replaced as a whole when their
+# rescan finishes, and the accounts with Classic resources of each service are indexed so a service does not need
+# to walk every account
+
+
+class ResultView:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store = ResultStore()
+        self.serviceaccounts = dict()
+        self.summarycache = None
+
+    def update(self, accountid, scantime, recordlist):
+        with self.lock:
+            if accountid in self.store.accounts:
+                for servicename in self.store.classiccounts(accountid):
+                    self.serviceaccounts[servicename].discard(accountid)
+            self.store.replace(accountid, scantime, recordlist)
+            for servicename in self.store.classiccounts(accountid):
+                self.serviceaccounts.setdefault(servicename, set()).add(accountid)
+            self.summarycache = None
+
+    def account(self, accountid):
+        with self.lock:
+            if accountid not in self.store.accounts:
+                return None
+            services = dict()
+            for region, servicename, resourceid, status in self.store.records(accountid):
+                services.setdefault(servicename, list()).append(
+                    {'region': region, 'resourceid': resourceid, 'status': status})
+            return {'scantime': self.store.accounts[accountid].scantime, 'services': services,
+                    'counts': self.store.classiccounts(accountid), 'account': accountid}
+
+    def service(self, servicename):
+        with self.lock:
+            return {accountid: [{'region': region, 'resourceid': resourceid, 'status': 'Classic'}
+                                for region, resourceid in self.store.classicresources(accountid, servicename)]
+                    for accountid in sorted(self.serviceaccounts.get(servicename, ()))}
+
+    def accountlist(self):
+        with self.lock:
+            return [{'account': accountid, 'scantime': self.store.accounts[accountid].scantime,
+                     'classicresources': self.store.classictotal(accountid)}
+                    for accountid in sorted(self.store.accounts)]
+
+    def summary(self):
+        with self.lock:
+            if self.summarycache is None:
+                self.summarycache = self.store.summary()
+            return self.summarycache
+
+
+# Serves the result view as JSON. /summary, /accounts, /accounts/<account ID> and /services/<service name>
+
+
+class ResultRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        resultview = self.server.resultview
+        pathparts = [pathpart for pathpart in self.path.split('?')[0].split('/') if pathpart]
+        if pathparts == ['summary']:
+            response = resultview.summary()
+        elif pathparts == ['accounts']:
+            response = resultview.accountlist()
+        elif len(pathparts) == 2 and pathparts[0] == 'accounts':
+            response = resultview.account(pathparts[1])
+        elif len(pathparts) == 2 and pathparts[0] == 'services' and pathparts[1] in servicechecks:
+            response = resultview.service(pathparts[1])
+        else:
+            response = None
+        if response is None:
+            self.send_error(404)
+            return
+        responsebody = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(responsebody)))
+        self.end_headers()
+        self.wfile.write(responsebody)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Builds the list of accounts or profiles to run against from the parsed arguments
+
+
+def buildtargets(argresult):
+    targets = list()
     if str(argresult) == 'default':
-        print("Default invocation detected. Running against local account. \n")
-        loopregions(classicregions, datapipelineregions, {})
+        targets.append(('credentials', 'default', {}))
     elif type(argresult) is dict:
-        print("Organization wide invocation detected. Running against all accounts in the organization. \n")
+        importboto()
         orgclient = boto3.client('organizations')
-        stsparentclient = boto3.client('sts')
         paginator = orgclient.get_paginator('list_accounts')
         page_iterator = paginator.paginate()
         accountslist = list()
@@ -808,49 +1897,291 @@ def main(argresult):
         else:
             rolename = 'ec2-classic-resource-finder'
 
-        if 'externalid' in argresult.keys():
-            for account in accountslist:
+        for account in accountslist:
+            credsource = {'rolearn': 'arn:aws:iam::' + account + ':role/' + rolename}
+            if 'externalid' in argresult.keys():
+                credsource['externalid'] = argresult['externalid']
+            targets.append(('account', account, credsource))
+    else:
+        for profile in argresult:
+            targets.append(('profile', profile, {'profile': profile}))
+    return targets
+
+
+# Runs as a service, rescanning a batch of accounts in rotation on every interval and serving the latest results
+# over HTTP on the local host. The worker processes, and the clients they hold, the assumed role credentials and the
+# duration history are kept between scans, and the history is saved at the end of every rotation
+
+
+def servedaemon(argresult, scanplan, options, credentialcache):
+    resultview = ResultView()
+    server = ThreadingHTTPServer(('127.0.0.1', options['serve']), ResultRequestHandler)
+    server.resultview = resultview
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Serving the latest results on http://127.0.0.1:' + str(options['serve']) + '/summary')
+
+    history = loadhistory(options['history'])
+    targets = list()
+    nexttarget = 0
+    workerpool = WorkerPool(options['workers'])
+    try:
+        while True:
+            if nexttarget >= len(targets):
+                if targets:
+                    savehistory(options['history'], history)
+                # The organization is listed again at the start of every rotation to pick up new accounts
                 try:
-                    rolearn = 'arn:aws:iam::' + account + ':role/' + rolename
-                    accountstscred = stsparentclient.assume_role(
-                        RoleArn=rolearn,
-                        RoleSessionName='ec2-classic-resource-finder',
-                        DurationSeconds=3600,
-                        ExternalId=argresult['externalid']
-                    )
-                    creddict['accesskey'] = accountstscred['Credentials']['AccessKeyId']
-                    creddict['secretkey'] = accountstscred['Credentials']['SecretAccessKey']
-                    creddict['sessiontoken'] = accountstscred['Credentials']['SessionToken']
-                    loopregions(classicregions, datapipelineregions, creddict)
+                    targets = buildtargets(argresult)
                 except Exception as e:
-                    print('Error running for account ' + str(account) + '. The error was: ' + str(e))
+                    print('Error listing the accounts to run against. The error was: ' + str(e))
+                nexttarget = 0
+            if options['rotation']:
+                batch = targets[nexttarget:nexttarget + options['rotation']]
+            else:
+                batch = targets[nexttarget:]
+            nexttarget += len(batch)
+            if batch:
+                scanaccounts(batch, scanplan, options, None, credentialcache, workerpool, resultview, history)
+            time.sleep(options['interval'])
+    except KeyboardInterrupt:
+        print('Stopping')
+    finally:
+        workerpool.shutdown()
+        server.shutdown()
+        server.server_close()
+        savehistory(options['history'], history)
+
+
+# Runs triage for an account and writes the result to the triage summary
+
+
+def triageaccount(creds, scanplan, triagefile, accountid=None):
+    accountid, executiontime, executionprefix = resolveaccount(creds, accountid)
+    if not os.path.exists(accountid):
+        os.mkdir(accountid)
+    triagestatus = triageregions(scanplan, creds, executionprefix)
+    triagefile.write(accountid + ', ' + triagestatus + '\n')
+    triagefile.flush()
+    print('Triage result for ' + accountid + ': ' + triagestatus)
+
+
+# Concatenates all regional files into single file per service
+
+
+def concatenateregions(scanplan, executionprefix):
+    for servicename in scanplan['services']:
+        suffix = servicechecks[servicename][2]
+        serviceoutput = open(executionprefix + suffix[1:], 'a')
+        for regionname in scanplan['regions']:
+            fileconcatenator(executionprefix, regionname, suffix, serviceoutput)
+        serviceoutput.close()
+
+
+# Concatenates all regional and per service error files into a single file
+
+
+def concatenateerrors(classicregionslist, executionprefix):
+    erroroutput = open(executionprefix + 'Errors.txt', 'a')
+    for regionname in classicregionslist:
+        fileconcatenator(executionprefix, regionname, '_errors.txt', erroroutput)
+        for servicename in servicechecks:
+            fileconcatenator(executionprefix, regionname, '_' + servicename + '_errors.txt', erroroutput)
+    erroroutput.close()
+
+
+# Moves the errors of a scan in service mode to the rolling error log of the account, with the time of the scan, so
+# rescans do not leave an error file behind for every scan
+
+
+def rollerrors(executionprefix, accountid, scantime):
+    scanerrors = ''
+    if os.path.exists(executionprefix + 'Errors.txt'):
+        readfile = open(executionprefix + 'Errors.txt', 'r')
+        scanerrors = readfile.read()
+        readfile.close()
+        deletefile(executionprefix + 'Errors.txt')
+    if scanerrors:
+        erroroutput = open(accountid + '/Errors.txt', 'a')
+        erroroutput.write(scantime + ' ' + scanerrors + '\n')
+        erroroutput.close()
+
+
+# Appends all regional record part files to the run output
+
+
+def concatenaterecords(classicregionslist, executionprefix, runwriter):
+    for regionname in classicregionslist:
+        for servicename in servicechecks:
+            runwriter.appendpart(executionprefix + regionname + '_' + servicename + '_records.jsonl.gz')
+
+
+# Merges the resource index part files of an account and writes the attributes of every Classic resource, with the
+# resources which depend on it, and the dependencies between resources. The target of each dependency is marked as
+# Classic if it was found by a check, Not found if its check found no such Classic resource, or Not checked
+
+
+def concatenategraph(classicregionslist, executionprefix, outputprefix, outputmode):
+    index = ResourceIndex()
+    for regionname in classicregionslist:
+        for servicename in servicechecks:
+            partfilename = executionprefix + regionname + '_' + servicename + '_graph.json'
+            if os.path.exists(partfilename):
+                index.load(partfilename)
+                deletefile(partfilename)
+    resourcedependents = index.dependents()
+    with open(outputprefix + 'Classic_Resource_Attributes.jsonl', outputmode) as attributesoutput:
+        for resourcekey, attributes in index.resources.items():
+            attributesoutput.write(json.dumps({'region': resourcekey[0], 'service': resourcekey[1],
+                                               'resourceid': resourcekey[2], 'attributes': attributes,
+                                               'dependents': resourcedependents.get(resourcekey, [])},
+                                              default=str) + '\n')
+    with open(outputprefix + 'Classic_Dependencies.csv', outputmode) as dependenciesoutput:
+        for region, sourceservice, sourceid, relation, targetservice, targetid in index.edges:
+            if (region, targetservice, targetid) in index.resources:
+                targetstatus = 'Classic'
+            elif targetservice in servicechecks:
+                targetstatus = 'Not found'
+            else:
+                targetstatus = 'Not checked'
+            dependenciesoutput.write(', '.join((region, sourceservice, sourceid, relation, targetservice, targetid,
+                                                targetstatus)) + '\n')
+
+
+# Reads the records of a jsonl or parquet results file written by a run
+
+
+def readrecords(filename):
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet
+        parquetfile = pyarrow.parquet.ParquetFile(filename)
+        for batch in parquetfile.iter_batches(columns=list(recordcolumns)):
+            for record in batch.to_pylist():
+                yield record
+    else:
+        if filename.endswith('.gz'):
+            readfile = gzip.open(filename, 'rt', encoding='utf-8')
         else:
-            for account in accountslist:
-                try:
-                    rolearn = 'arn:aws:iam::' + account + ':role/' + rolename
-                    accountstscred = stsparentclient.assume_role(
-                        RoleArn=rolearn,
-                        RoleSessionName='ec2-classic-resource-finder',
-                        DurationSeconds=3600
-                    )
-                    creddict['accesskey'] = accountstscred['Credentials']['AccessKeyId']
-                    creddict['secretkey'] = accountstscred['Credentials']['SecretAccessKey']
-                    creddict['sessiontoken'] = accountstscred['Credentials']['SessionToken']
-                    loopregions(classicregions, datapipelineregions, creddict)
-                except Exception as e:
-                    print('Error running for account ' + str(account) + '. The error was: ' + str(e))
+            readfile = open(filename, 'r', encoding='utf-8')
+        with readfile:
+            for line in readfile:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Loads a results file into a result store. The run output does not include scan times
+
+
+def loadresults(filename):
+    store = ResultStore()
+    for record in readrecords(filename):
+        accountresults = store.accounts.get(record['account'])
+        if accountresults is None:
+            accountresults = store.addaccount(record['account'], '')
+        store.addrecord(accountresults, record['region'], record['service'], record['resourceid'], record['status'])
+    return store
+
+
+# Summarises a results file and writes the records added and removed since a previous results file
+
+
+def compareresults(previousfilename, currentfilename):
+    previous = loadresults(previousfilename)
+    current = loadresults(currentfilename)
+    summary = current.summary()
+    print(currentfilename + ' has ' + str(summary['accounts']) + ' accounts, ' + str(summary['accountswithclassic']) +
+          ' with Classic resources.')
+    for servicename in servicechecks:
+        if servicename in summary['services']:
+            print(servicename + ': ' + str(summary['services'][servicename]['classicresources']) +
+                  ' Classic resources in ' + str(summary['services'][servicename]['accounts']) + ' accounts')
+    changesfilename = datetime.now().strftime("%d-%m-%Y-%H-%M-%S_") + 'Classic_Changes.csv'
+    changecounts = dict()
+    with open(changesfilename, 'a') as changesfile:
+        for change in current.diff(previous):
+            changesfile.write(', '.join(change) + '\n')
+            changecounts[change[-1]] = changecounts.get(change[-1], 0) + 1
+    print(str(changecounts.get('Added', 0)) + ' records added and ' + str(changecounts.get('Removed', 0)) +
+          ' removed since ' + previousfilename + ', ' + str(changecounts.get('Not scanned', 0)) +
+          ' accounts were not scanned.')
+    print('Changes written to ' + changesfilename)
+
+
+# Main Function
+def main(argresult, options):
+    if 'compare' in options:
+        compareresults(*options['compare'])
+        return
+
+    scanplan = buildscanplan(options)
+    print('Checking ' + str(len(scanplan['services'])) + ' services across ' + str(len(scanplan['regions'])) +
+          ' regions, ' + str(len(scanplan['units'])) + ' checks per account. \n')
+
+    if options['memorycap'] and 'triage' not in options:
+        # A cap below the memory a worker needs before fetching anything would shrink every page and replace the
+        # pool on every check
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            workerbaseline = executor.submit(baselinememory).result()
+        if options['memorycap'] <= workerbaseline:
+            print('The memory cap of ' + str(options['memorycap'] // 1048576) + ' MB is below the ' +
+                  str(workerbaseline // 1048576 + 1) + ' MB a worker process uses once boto3 and a client are loaded. '
+                  'Use a larger --memory-cap.')
+            sys.exit(2)
+
+    credentialcache = CredentialCache()
+
+    if str(argresult) == 'default':
+        print("Default invocation detected. Running against local account. \n")
+    elif type(argresult) is dict:
+        print("Organization wide invocation detected. Running against all accounts in the organization. \n")
     else:
         print("Profile invocation detected. Running against all listed profiles. \n")
-        for profile in argresult:
+
+    if 'sqlite' in options and 'triage' not in options:
+        initdatabase(options['sqlite'])
+
+    if 'serve' in options:
+        servedaemon(argresult, scanplan, options, credentialcache)
+        return
+
+    targets = buildtargets(argresult)
+
+    if 'triage' in options:
+        # Triage only writes the per account summary
+        triagefilename = datetime.now().strftime("%d-%m-%Y-%H-%M-%S_") + 'Classic_Triage.csv'
+        triagefile = open(triagefilename, 'a')
+        for targettype, targetname, credsource in targets:
+            accountid = targetname if targettype == 'account' else None
             try:
-                creddict['profile'] = profile
-                loopregions(classicregions, datapipelineregions, creddict)
+                creds = credentialcache.get(credsource)
+                if accountid is None:
+                    accountid = resolveaccount(creds)[0]
+                triageaccount(creds, scanplan, triagefile, accountid)
             except Exception as e:
-                print('Error running for profile ' + str(profile) + '. The error was: ' + str(e))
+                print('Error running for ' + targettype + ' ' + str(targetname) + '. The error was: ' + str(e))
+                # Rows for targets whose account ID could not be found name the profile instead
+                if accountid is None:
+                    triagefile.write(targettype + ' ' + str(targetname) + ', unknown\n')
+                else:
+                    triagefile.write(accountid + ', unknown\n')
+        triagefile.close()
+        print('Triage results written to ' + triagefilename)
+        return
+
+    runwriter = None
+    if options['format'] != 'csv':
+        runfilename = datetime.now().strftime("%d-%m-%Y-%H-%M-%S_") + runfilesuffixes[options['format']]
+        runwriter = RecordWriter(options['format'], runfilename)
+
+    try:
+        scanaccounts(targets, scanplan, options, runwriter, credentialcache)
+    finally:
+        if runwriter is not None:
+            runwriter.close()
+            print('Results written to ' + runfilename)
 
 
 # Execute the main function
 
 if __name__ == '__main__':
-    main(argparser(sys.argv[1:]))
+    main(*argparser(sys.argv[1:]))
     print('finished')